@@ -3,41 +3,324 @@
 Script that converts a Markdown file to HTML (supports headings, unordered/ordered lists,
 paragraphs, bold, italics, MD5 [[text]], and remove c ((text))).
 
-Usage: ./markdown2html.py <input_markdown> <output_html>
+Usage: ./markdown2html.py <input_markdown> <output_html|->
+       ./markdown2html.py --batch <manifest> <output_dir>
 """
 
 import os
 import sys
 import re
 import hashlib
+import stat
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 
-def parse_formatting(text):
+_H_OPEN = ('',) + tuple(f"<h{i}>" for i in range(1, 7))
+_H_CLOSE = ('',) + tuple(f"</h{i}>" for i in range(1, 7))
+
+_UL_OPEN = sys.intern("<ul>")
+_UL_CLOSE = sys.intern("</ul>")
+_OL_OPEN = sys.intern("<ol>")
+_OL_CLOSE = sys.intern("</ol>")
+_P_OPEN = sys.intern("<p>")
+_P_CLOSE = sys.intern("</p>")
+_BR = sys.intern("<br/>")
+
+
+_DELETE_C = str.maketrans('', '', 'cC')
+
+
+def remove_c(text):
+    """Return text with all 'c' and 'C' removed."""
+    return text.translate(_DELETE_C)
+
+
+@lru_cache(maxsize=1024)
+def md5_hash(text):
+    """Return the lowercase MD5 hex digest of text."""
+    return hashlib.md5(text.encode(), usedforsecurity=False).hexdigest()
+
+
+def _md5_span(inner):
+    """Hash a [[...]] span; one whose content was removed stays literal."""
+    return md5_hash(inner) if inner else "[[]]"
+
+
+# Inline syntaxes as (opening marker, pattern, renderer), in the order
+# their rules apply: a span's content sees the earlier rules before it
+# is rendered, and the later rules after.
+_SPANS = (
+    ('**', r"\*\*(.+?)\*\*", lambda inner: f"<b>{inner}</b>"),
+    ('__', r"__(.+?)__", lambda inner: f"<em>{inner}</em>"),
+    ('((', r"\(\((.+?)\)\)", remove_c),
+    ('[[', r"\[\[(.+?)\]\]", _md5_span),
+)
+
+
+def _document_features(source):
+    """
+    Return, for each entry of _SPANS, whether its rule may apply.
+
+    Removing 'c' inside ((...)) can create the marker of a later rule,
+    as in (([c[x]c])), so when '((' occurs the later markers are also
+    looked for in the source with every 'c' and 'C' deleted.
+
+    >>> _document_features('(([c[x]c]))')
+    (False, False, True, True)
+    """
+    features = [marker in source for marker, _, _ in _SPANS]
+    if '((' in source:
+        stripped = source.translate(_DELETE_C)
+        later = [marker for marker, _, _ in _SPANS].index('((') + 1
+        for i in range(later, len(_SPANS)):
+            features[i] = features[i] or _SPANS[i][0] in stripped
+    return tuple(features)
+
+
+def _build_parse_formatting(features):
+    """
+    Return a parse_formatting function that handles only the inline
+    syntaxes whose entry in features is true.
+
+    A document with no inline markup at all gets the identity function.
+    """
+    enabled = tuple(i for i, used in enumerate(features) if used)
+    if not enabled:
+        return lambda text: text
+
+    subs = {}
+
+    def sub_for(rules):
+        """
+        Return a function applying the given _SPANS rules in one pass,
+        or None if rules is empty.
+        """
+        if not rules:
+            return None
+        if rules in subs:
+            return subs[rules]
+        markers = tuple(_SPANS[i][0] for i in rules)
+        inline_re = re.compile("|".join(_SPANS[i][1] for i in rules))
+        # Indexed by match.lastindex - 1: the rules applied before and
+        # after rendering a span of that rule, and its renderer.
+        plans = tuple(
+            (sub_for(tuple(i for i in rules if i < rule)),
+             sub_for(tuple(i for i in rules if i > rule)),
+             _SPANS[rule][2])
+            for rule in rules)
+
+        def format_span(match):
+            """Render one span in rule order: earlier, own, later rules."""
+            before, after, render = plans[match.lastindex - 1]
+            inner = match.group(match.lastindex)
+            if before is not None:
+                inner = before(inner)
+            text = render(inner)
+            if after is not None:
+                text = after(text)
+            return text
+
+        def format_text(text):
+            """Apply the rules, or return text if none of them can match."""
+            for marker in markers:
+                if marker in text:
+                    return inline_re.sub(format_span, text)
+            return text
+
+        subs[rules] = format_text
+        return format_text
+
+    format_all = sub_for(enabled)
+
+    @lru_cache(maxsize=4096)
+    def parse_formatting(text):
+        """
+        Convert Markdown formatting and custom syntaxes to HTML:
+        - **text** -> <b>text</b>
+        - __text__ -> <em>text</em>
+        - ((text)) -> remove all 'c' or 'C'
+        - [[text]] -> MD5 hash (lowercase)
+
+        All syntaxes are matched in a single left-to-right pass. Nested
+        spans give the same result as applying the rules one after the
+        other in the order above:
+
+        >>> parse_formatting('((x[[abc]]y))')
+        'x187ef4436122d1cc2f40dc2b92f0eba0y'
+        >>> parse_formatting('[[((c))]]')
+        '[[]]'
+        >>> parse_formatting('((**c**))')
+        '<b></b>'
+        >>> parse_formatting('**((c))**')
+        '<b></b>'
+        >>> parse_formatting('[[**a**]]')
+        'd0d0b371e07faa35478d8dde673a8cc5'
+        >>> parse_formatting('(([c[x]c]))') == md5_hash('x')
+        True
+        """
+        return format_all(text)
+
+    return parse_formatting
+
+
+parse_formatting = _build_parse_formatting((True,) * len(_SPANS))
+
+
+# Output token kinds, stored in _ParserState.kinds.
+_TOK_TEXT, _TOK_HEADING, _TOK_ITEM = range(3)
+
+# Indexed by output token kind; each builds one HTML line.
+_EMIT = (
+    lambda level, body: body,
+    lambda level, body: _H_OPEN[level] + body + _H_CLOSE[level],
+    lambda level, body: "<li>" + body + "</li>",
+)
+
+
+class _ParserState:
+    """
+    Mutable state shared by the block-level line handlers.
+
+    Output is kept as three parallel sequences (token kind, heading
+    level, body text) and only turned into HTML strings by render().
+    """
+
+    __slots__ = ('format', 'kinds', 'levels', 'bodies',
+                 'in_ul', 'in_ol', 'paragraph_lines')
+
+    def __init__(self, formatter):
+        self.format = formatter
+        self.kinds = array('b')
+        self.levels = array('b')
+        self.bodies = []
+        self.in_ul = False
+        self.in_ol = False
+        self.paragraph_lines = []
+
+    def emit(self, kind, body, level=0):
+        """Append one output token."""
+        self.kinds.append(kind)
+        self.levels.append(level)
+        self.bodies.append(body)
+
+    def render(self):
+        """Return the output tokens as a list of HTML lines."""
+        emit = _EMIT
+        return [emit[k](lv, b)
+                for k, lv, b in zip(self.kinds, self.levels, self.bodies)]
+
+
+def _flush_paragraph(state):
     """
-    Convert Markdown formatting and custom syntaxes to HTML:
-    - **text** -> <b>text</b>
-    - __text__ -> <em>text</em>
-    - [[text]] -> MD5 hash (lowercase)
-    - ((text)) -> remove all 'c' or 'C'
+    Emit the buffered paragraph and clear the buffer.
+
+    The already formatted lines are joined once, with each line after
+    the first starting with <br/>, and emitted as a single body.
     """
-    text = re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", text)
-    text = re.sub(r"__(.+?)__", r"<em>\1</em>", text)
+    if state.paragraph_lines:
+        state.emit(_TOK_TEXT, _P_OPEN)
+        state.emit(_TOK_TEXT, ("\n" + _BR).join(state.paragraph_lines))
+        state.emit(_TOK_TEXT, _P_CLOSE)
+        state.paragraph_lines.clear()
+
 
-    def remove_c(match):
-        return match.group(1).replace('c', '').replace('C', '')
-    text = re.sub(r"\(\((.+?)\)\)", remove_c, text)
+def _close_ul(state):
+    """Close the open unordered list, if any."""
+    if state.in_ul:
+        state.emit(_TOK_TEXT, _UL_CLOSE)
+        state.in_ul = False
 
-    def md5_hash(match):
-        s = match.group(1)
-        return hashlib.md5(s.encode()).hexdigest()
-    text = re.sub(r"\[\[(.+?)\]\]", md5_hash, text)
 
-    return text
+def _close_ol(state):
+    """Close the open ordered list, if any."""
+    if state.in_ol:
+        state.emit(_TOK_TEXT, _OL_CLOSE)
+        state.in_ol = False
 
 
-def parse_markdown(lines):
+# One alternative per block kind; the group that matched selects the
+# handler.  A heading or list marker followed only by whitespace is not
+# a heading or list item.
+_BLOCK_RE = re.compile(
+    r"^(?:(#{1,6}) (.*\S.*)"   # 1, 2: heading level and body
+    r"|- (.*\S.*)"             # 3: unordered list item
+    r"|\* (.*\S.*)"           # 4: ordered list item
+    r"|(#.*)"                  # 5: malformed heading
+    r"|[^\S\n]*"               # blank line
+    r"|(.*))$",                # 6: paragraph text
+    re.MULTILINE,
+)
+
+
+def _handle_blank(match, state):
+    """Blank line: end the current paragraph and any open list."""
+    _flush_paragraph(state)
+    _close_ul(state)
+    _close_ol(state)
+
+
+def _handle_para(match, state):
+    """Plain text line: add it to the current paragraph."""
+    state.paragraph_lines.append(
+        state.format(match.group(match.lastindex).rstrip()))
+
+
+def _handle_new_para(match, state):
+    """Malformed heading: end the current paragraph and start a new one."""
+    _flush_paragraph(state)
+    _handle_para(match, state)
+
+
+def _handle_heading(match, state):
+    """Heading line: end any paragraph or list and emit <hN>."""
+    _flush_paragraph(state)
+    _close_ul(state)
+    _close_ol(state)
+    state.emit(_TOK_HEADING, state.format(match.group(2).strip()),
+               len(match.group(1)))
+
+
+def _handle_ul(match, state):
+    """'- ' line: unordered list item."""
+    _flush_paragraph(state)
+    _close_ol(state)
+    if not state.in_ul:
+        state.emit(_TOK_TEXT, _UL_OPEN)
+        state.in_ul = True
+    state.emit(_TOK_ITEM, state.format(match.group(3).strip()))
+
+
+def _handle_ol(match, state):
+    """'* ' line: ordered list item."""
+    _flush_paragraph(state)
+    _close_ul(state)
+    if not state.in_ol:
+        state.emit(_TOK_TEXT, _OL_OPEN)
+        state.in_ol = True
+    state.emit(_TOK_ITEM, state.format(match.group(4).strip()))
+
+
+# Indexed by the lastindex of a _BLOCK_RE match (None, i.e. a blank
+# line, maps to 0).
+_HANDLERS = (
+    _handle_blank,
+    None,
+    _handle_heading,
+    _handle_ul,
+    _handle_ol,
+    _handle_new_para,
+    _handle_para,
+)
+
+
+def parse_markdown(source, formatter=parse_formatting):
     """
-    Convert a list of Markdown lines to HTML lines.
+    Convert Markdown source text to HTML lines.
+
+    formatter renders inline syntax; pass a function returned by
+    _build_parse_formatting() to skip syntaxes the source does not use.
 
     Supports:
     - Headings: # to ######
@@ -49,89 +332,152 @@ def parse_markdown(lines):
     - [[text]]: MD5 hash
     - ((text)): remove all 'c' or 'C'
     """
-    html_lines = []
-    in_ul = False
-    in_ol = False
-    paragraph_lines = []
-
-    def flush_paragraph():
-        """Convert collected paragraph lines to HTML and clear the buffer."""
-        if paragraph_lines:
-            html_lines.append("<p>")
-            for i, pline in enumerate(paragraph_lines):
-                pline = parse_formatting(pline)
-                html_lines.append(pline if i == 0 else f"<br/>{pline}")
-            html_lines.append("</p>")
-            paragraph_lines.clear()
-
-    for line in lines:
-        line = line.rstrip()
-
-        if not line.strip():
-            flush_paragraph()
-            if in_ul:
-                html_lines.append("</ul>")
-                in_ul = False
-            if in_ol:
-                html_lines.append("</ol>")
-                in_ol = False
-            continue
+    state = _ParserState(formatter)
+    handlers = _HANDLERS
 
-        if line.startswith('#'):
-            flush_paragraph()
-            i = 0
-            while i < len(line) and line[i] == '#':
-                i += 1
-            if 1 <= i <= 6 and line[i] == ' ':
-                if in_ul:
-                    html_lines.append("</ul>")
-                    in_ul = False
-                if in_ol:
-                    html_lines.append("</ol>")
-                    in_ol = False
-                html_lines.append(f"<h{i}>{parse_formatting(line[i+1:].strip())}</h{i}>")
-                continue
-
-        if line.startswith('- '):
-            flush_paragraph()
-            if in_ol:
-                html_lines.append("</ol>")
-                in_ol = False
-            if not in_ul:
-                html_lines.append("<ul>")
-                in_ul = True
-            html_lines.append(f"<li>{parse_formatting(line[2:].strip())}</li>")
-            continue
+    for match in _BLOCK_RE.finditer(source):
+        handlers[match.lastindex or 0](match, state)
 
-        if line.startswith('* '):
-            flush_paragraph()
-            if in_ul:
-                html_lines.append("</ul>")
-                in_ul = False
-            if not in_ol:
-                html_lines.append("<ol>")
-                in_ol = True
-            html_lines.append(f"<li>{parse_formatting(line[2:].strip())}</li>")
+    _handle_blank(None, state)
+
+    return state.render()
+
+
+def _open_temp(directory):
+    """
+    Exclusively create a uniquely named file in directory and return
+    (fd, path). Unlike tempfile.mkstemp the file gets the usual 0666
+    mode minus the umask, so a new output is not left private.
+    """
+    while True:
+        path = os.path.join(directory,
+                            f".markdown2html-{os.urandom(6).hex()}.tmp")
+        try:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+            return os.open(path, flags, 0o666), path
+        except FileExistsError:
             continue
 
-        paragraph_lines.append(line)
 
-    flush_paragraph()
+def _write_in_place(output_file, blob):
+    """Write blob by opening output_file itself."""
+    with open(output_file, 'wb', buffering=1 << 16) as f:
+        f.write(blob)
+
 
-    if in_ul:
-        html_lines.append("</ul>")
-    if in_ol:
-        html_lines.append("</ol>")
+def _write_output(output_file, blob):
+    """
+    Write blob to output_file, or to stdout if output_file is '-'.
+
+    A missing or regular output file is written to a uniquely named
+    temporary file in the same directory and renamed into place, so
+    readers never see a partially written output; an existing file
+    keeps its mode. Anything else (a symlink, device or FIFO), or a
+    directory where no temporary file can be created, is written in
+    place.
+    """
+    if output_file == '-':
+        sys.stdout.buffer.write(blob)
+        sys.stdout.flush()
+        return
+
+    try:
+        st = os.lstat(output_file)
+    except FileNotFoundError:
+        st = None
+    if st is not None and not stat.S_ISREG(st.st_mode):
+        _write_in_place(output_file, blob)
+        return
 
-    return html_lines
+    try:
+        fd, tmp = _open_temp(os.path.dirname(output_file) or '.')
+    except PermissionError:
+        _write_in_place(output_file, blob)
+        return
+    try:
+        with os.fdopen(fd, 'wb', buffering=1 << 16) as f:
+            if st is not None:
+                os.fchmod(f.fileno(), stat.S_IMODE(st.st_mode))
+            f.write(blob)
+        os.replace(tmp, output_file)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _convert_one(input_file, output_file):
+    """Convert one Markdown file to an HTML file."""
+    with open(input_file, 'r', encoding='utf-8') as f:
+        source = f.read()
+
+    formatter = _build_parse_formatting(_document_features(source))
+    html_lines = parse_markdown(source, formatter)
+
+    blob = b''
+    if html_lines:
+        blob = ('\n'.join(html_lines) + '\n').encode('utf-8')
+
+    _write_output(output_file, blob)
+
+
+def main_batch(manifest, output_dir):
+    """
+    Convert every Markdown file listed in manifest into output_dir.
+
+    The manifest holds one input path per line; each output is named
+    after its input with an .html extension. Inputs whose output name
+    is already taken by an earlier input are rejected. Files are
+    converted in parallel, one worker process per CPU.
+
+    Returns 0 on success, 1 if any input was missing, rejected or
+    failed to convert.
+    """
+    with open(manifest, 'r', encoding='utf-8') as f:
+        paths = [line.strip() for line in f.read().splitlines()
+                 if line.strip()]
+
+    status = 0
+    jobs = []
+    owners = {}
+    for input_file in paths:
+        if not os.path.isfile(input_file):
+            print(f"Missing {input_file}", file=sys.stderr)
+            status = 1
+            continue
+        name = os.path.splitext(os.path.basename(input_file))[0] + '.html'
+        if name in owners:
+            print(f"Duplicate output {name} for {input_file}"
+                  f" (already used by {owners[name]})", file=sys.stderr)
+            status = 1
+            continue
+        owners[name] = input_file
+        jobs.append((input_file, os.path.join(output_dir, name)))
+
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(_convert_one, i, o) for i, o in jobs]
+        for (input_file, _), future in zip(jobs, futures):
+            try:
+                future.result()
+            except Exception as err:
+                print(f"Failed {input_file}: {err}", file=sys.stderr)
+                status = 1
+
+    return status
 
 
 def main():
     """Check arguments, read Markdown, and write HTML."""
-    if len(sys.argv) != 3:
-        print("Usage: ./markdown2html.py README.md README.html", file=sys.stderr)
+    batch = len(sys.argv) > 1 and sys.argv[1] == '--batch'
+    if len(sys.argv) != (4 if batch else 3):
+        print("Usage: ./markdown2html.py README.md README.html\n"
+              "       ./markdown2html.py --batch manifest.txt out_dir",
+              file=sys.stderr)
         sys.exit(1)
 
+    if batch:
+        sys.exit(main_batch(sys.argv[2], sys.argv[3]))
+
     input_file = sys.argv[1]
     output_file = sys.argv[2]
 
@@ -139,14 +485,7 @@ def main():
         print(f"Missing {input_file}", file=sys.stderr)
         sys.exit(1)
 
-    with open(input_file, 'r', encoding='utf-8') as f:
-        markdown_lines = f.readlines()
-
-    html_lines = parse_markdown(markdown_lines)
-
-    with open(output_file, 'w', encoding='utf-8') as f:
-        for line in html_lines:
-            f.write(line + "\n")
+    _convert_one(input_file, output_file)
 
     sys.exit(0)
 